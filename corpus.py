@@ -0,0 +1,33 @@
+# corpus.py
+"""
+將爬取到的新聞文章組成送給 GPT 的文字段落
+
+本模組只有純 Python 與完整型別標註，可用 mypyc 編譯成擴充模組以加速：
+    mypyc corpus.py
+編譯產物（.so / .pyd）與原始碼同名，import 時會優先載入；未編譯時直接執行原始碼。
+"""
+from typing import Dict, List
+
+
+def build_corpus(articles: List[Dict[str, str]], limit: int) -> str:
+    """
+    將前 limit 篇文章組成含標題、連結與內文的全文段落
+    """
+    docs: List[str] = []
+    i: int
+    for i in range(min(limit, len(articles))):
+        a: Dict[str, str] = articles[i]
+        docs.append(f"【第 {i + 1} 篇】\n標題：{a['title']}\n連結：{a['link']}\n內文：\n{a['content']}\n")
+    return "\n".join(docs)
+
+
+def build_digest(articles: List[Dict[str, str]], limit: int, chars: int = 300) -> str:
+    """
+    將前 limit 篇文章組成只含標題、日期與內文開頭的摘要段落
+    """
+    docs: List[str] = []
+    i: int
+    for i in range(min(limit, len(articles))):
+        a: Dict[str, str] = articles[i]
+        docs.append(f"標題：{a['title']}\n日期：{a['date']}\n摘要：{a['content'][:chars]}...")
+    return "\n---\n".join(docs)
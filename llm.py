@@ -0,0 +1,107 @@
+# llm.py
+"""
+mc.py、mo.py 與 server.py 共用的 GPT 相關工具
+"""
+import atexit
+import os
+import time
+from typing import AsyncIterator
+
+import orjson
+from openai import AsyncOpenAI
+
+
+# 放進 prompt 的 JSON 保留縮排方便模型閱讀，並可直接序列化 numpy 數值
+_PROMPT_JSON_OPTS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def prompt_json(obj: object) -> str:
+    """
+    將資料序列化成放進 prompt 的 JSON 字串
+    """
+    return orjson.dumps(obj, option=_PROMPT_JSON_OPTS).decode()
+
+
+async def stream_chat(client: AsyncOpenAI, messages: list[dict], temperature: float) -> AsyncIterator[str]:
+    """
+    以串流方式呼叫 GPT-4o，逐段產出回覆內容
+    """
+    stream = await client.chat.completions.create(
+        model="gpt-4o",
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+class ParseCache:
+    """
+    問題解析結果的磁碟快取，以正規化後的問題字串為 key
+
+    每筆結果記錄寫入時間，超過 ttl 秒即視為過期，避免「最近一季」這類隨時間改變的推測值一直沿用。
+    程式結束時先重新讀取檔案、合併後再寫回，多個伺服器共用同一個快取檔時不會互相覆蓋。
+    """
+
+    def __init__(self, path: str, ttl: float) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._entries = self._load()
+        atexit.register(self.save)
+
+    @staticmethod
+    def _key(question: str) -> str:
+        return question.strip().lower()
+
+    def _fresh(self, entry: dict, now: float) -> bool:
+        return now - entry.get("ts", 0) < self.ttl
+
+    def _load(self) -> dict[str, dict]:
+        """
+        讀取快取檔中未過期的項目，檔案不存在或格式不符時回傳空的快取
+        """
+        try:
+            with open(self.path, "rb") as f:
+                entries = orjson.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        now = time.time()
+        return {
+            key: entry for key, entry in entries.items()
+            if isinstance(entry, dict) and "parsed" in entry and self._fresh(entry, now)
+        }
+
+    def get(self, question: str) -> dict | None:
+        """
+        取得未過期的解析結果，沒有快取時回傳 None
+        """
+        entry = self._entries.get(self._key(question))
+        if entry is not None and self._fresh(entry, time.time()):
+            return entry["parsed"]
+        return None
+
+    def set(self, question: str, parsed: dict) -> None:
+        self._entries[self._key(question)] = {"ts": time.time(), "parsed": parsed}
+
+    def save(self) -> None:
+        """
+        與檔案中現有的項目合併（同一個 key 保留較新的結果）後寫回
+        """
+        now = time.time()
+        merged = self._load()
+        for key, entry in self._entries.items():
+            if self._fresh(entry, now) and entry["ts"] > merged.get(key, {}).get("ts", 0):
+                merged[key] = entry
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(orjson.dumps(merged))
+            # 以 rename 取代檔案，其他行程讀取時不會讀到寫到一半的內容
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
@@ -2,25 +2,53 @@
 from fastmcp import FastMCP
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
+import anyio
+import asyncio
+import contextlib
 import os
-import json
+import orjson
 import sys
 import traceback
+from typing import AsyncIterator
+try:
+    import uvloop
+except ImportError:  # Windows 不支援 uvloop，沿用 asyncio 預設事件迴圈
+    uvloop = None
 from tools.mops_report import fetch_mops_report
-from tools.news_summary import crawl_etnews_articles
+from tools.news_summary import close_client, crawl_etnews_articles, fit_token_budget
+from corpus import build_corpus, build_digest
+from llm import ParseCache, prompt_json, stream_chat
 
 # 載入環境變數
 load_dotenv()
+# 伺服器關閉時，在同一個事件迴圈內關閉爬蟲共用的 HTTP client
+@contextlib.asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    try:
+        yield
+    finally:
+        await close_client()
+
 # 初始化 FastMCP 服務器
-mcp = FastMCP("smart_finance_server")
+mcp = FastMCP("smart_finance_server", lifespan=_lifespan)
 # 初始化 OpenAI 客戶端
 client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# 批次分析時同時收集資料的問題數上限
+_BATCH_PREP_CONCURRENCY = 4
+
+# 問題解析結果快取，與 mc.py 共用同一個檔案，保留 7 天
+_PARSE_CACHE = ParseCache(os.path.join(".cache", "parse_cache.json"), ttl=7 * 86400)
+
 @mcp.tool()
 async def parse_question(question: str) -> dict:
     """
     將使用者輸入的財經問題轉換為結構化的 JSON 格式
     """
+    cached = _PARSE_CACHE.get(question)
+    if cached is not None:
+        return cached
+
     prompt = f"""
 你是一個財經語意分析助手，請將下列問題解析為結構化的 JSON 格式。若有缺漏資訊，請合理推測或補齊。
 
@@ -39,25 +67,26 @@ stock_id 與 company 為必填。
         chat = await client.chat.completions.create(
             model="gpt-4o",
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
+            temperature=0,
         )
         result = chat.choices[0].message.content.strip()
-        return json.loads(result)
-    except json.JSONDecodeError as e:
+        parsed = orjson.loads(result)
+        _PARSE_CACHE.set(question, parsed)
+        return parsed
+    except orjson.JSONDecodeError as e:
         return {"error": f"解析失敗：無法解析 JSON: {e}", "raw": result}
     except Exception as e:
         return {"error": f"解析失敗：{e}"}
 
-@mcp.tool()
-async def analyze_financial_data(question: str, stock_id: str = "", company: str = "", topic: str = "", pages: int = 1) -> str:
+async def _build_analysis_prompt(question: str, stock_id: str = "", company: str = "", topic: str = "", pages: int = 1) -> str:
     """
-    整合財報與新聞資訊，針對使用者問題進行綜合分析
+    收集新聞與財報資料並組成分析用的 prompt，問題解析失敗時拋出 ValueError
     """
     # 如果未提供股票代號和公司名稱，先解析問題
     if not stock_id or not company:
         parsed = await parse_question(question)
         if "error" in parsed:
-            return f"⚠️ 問題解析失敗：{parsed['error']}"
+            raise ValueError(f"問題解析失敗：{parsed['error']}")
         
         stock_id = parsed.get("stock_id", "")
         company = parsed.get("company", "")
@@ -80,10 +109,9 @@ async def analyze_financial_data(question: str, stock_id: str = "", company: str
     else:
         reports = {}
     
-    # 使用 GPT 分析資料
-    news_summary = "\n---\n".join([f"標題：{a['title']}\n日期：{a['date']}\n摘要：{a['content'][:300]}..." for a in news[:3]]) if news else "未找到相關新聞"
+    news_summary = build_digest(news, 3) if news else "未找到相關新聞"
     
-    prompt = f"""
+    return f"""
 我正在分析關於 {company} (股票代號: {stock_id}) 的財經資訊，請根據以下資料回答問題：
 
 【問題】
@@ -94,21 +122,119 @@ async def analyze_financial_data(question: str, stock_id: str = "", company: str
 {news_summary}
 
 【財報資料】
-{json.dumps(reports, ensure_ascii=False, indent=2)[:2000]}...
+{prompt_json(reports)[:2000]}...
 
 請針對問題提供簡短但有深度的分析，提供具體數據支持，並給出風險評估與建議。語氣專業但易懂。
 """
+
+@mcp.tool()
+async def analyze_financial_data(question: str, stock_id: str = "", company: str = "", topic: str = "", pages: int = 1) -> str:
+    """
+    整合財報與新聞資訊，針對使用者問題進行綜合分析
+    """
+    try:
+        prompt = await _build_analysis_prompt(question, stock_id, company, topic, pages)
+    except ValueError as e:
+        return f"⚠️ {e}"
     
+    # 使用 GPT 分析資料
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-        )
-        return response.choices[0].message.content.strip()
+        parts = [part async for part in stream_chat(client, [{"role": "user", "content": prompt}], 0.7)]
+        return "".join(parts).strip()
     except Exception as e:
         return f"❌ 分析失敗：{e}"
 
+@mcp.tool()
+async def analyze_financial_data_batch(questions: list[str], pages: int = 1) -> dict:
+    """
+    透過 OpenAI Batch API 送出多個問題的分析請求，費用約為即時呼叫的一半，但最長需 24 小時才會完成。
+    本工具只收集資料並送出批次，回傳 batch_id，之後以 collect_financial_data_batch 取回結果；
+    需要即時回覆的單一問題請使用 analyze_financial_data。
+    """
+    # 資料收集仍需即時爬取，限制同時準備的問題數以免對來源網站造成壓力
+    sem = asyncio.Semaphore(_BATCH_PREP_CONCURRENCY)
+
+    async def _prepare(question: str) -> str:
+        async with sem:
+            return await _build_analysis_prompt(question, pages=pages)
+
+    prompts = await asyncio.gather(*(_prepare(q) for q in questions), return_exceptions=True)
+
+    lines = []
+    failed = []
+    for i, prompt in enumerate(prompts):
+        if isinstance(prompt, Exception):
+            failed.append({"index": i, "question": questions[i], "answer": f"⚠️ {prompt}"})
+            continue
+        # custom_id 為問題在 questions 中的位置，取回結果時據此對應
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o",
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": 0.7,
+            },
+        }))
+
+    if not lines:
+        return {"status": "error", "message": "⚠️ 沒有可送出的問題", "failed": failed}
+
+    try:
+        batch_file = await client.files.create(file=("analysis_batch.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+    except Exception as e:
+        return {"status": "error", "message": f"❌ 批次送出失敗：{e}", "failed": failed}
+
+    return {"batch_id": batch.id, "status": batch.status, "failed": failed}
+
+@mcp.tool()
+async def collect_financial_data_batch(batch_id: str) -> dict:
+    """
+    查詢 analyze_financial_data_batch 送出的批次；尚未結束時只回傳目前狀態，
+    結束後回傳每個問題的分析結果，index 對應送出時 questions 中的位置
+    """
+    try:
+        batch = await client.batches.retrieve(batch_id)
+    except Exception as e:
+        return {"status": "error", "message": f"❌ 批次查詢失敗：{e}"}
+
+    if batch.status not in ("completed", "failed", "expired", "cancelled"):
+        return {"batch_id": batch_id, "status": batch.status}
+
+    answers: dict[int, str] = {}
+    try:
+        # 成功的請求寫在 output 檔，批次內個別失敗的請求寫在 error 檔，兩者每行格式相同
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                record = orjson.loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    answer = response["body"]["choices"][0]["message"]["content"].strip()
+                else:
+                    answer = f"❌ 分析失敗：{record.get('error') or response.get('body')}"
+                answers[int(record["custom_id"])] = answer
+    except Exception as e:
+        return {"status": "error", "message": f"❌ 批次結果讀取失敗：{e}"}
+
+    result = {
+        "batch_id": batch_id,
+        "status": batch.status,
+        "results": [{"index": i, "answer": a} for i, a in sorted(answers.items())],
+    }
+    if batch.status != "completed":
+        # 過期或取消的批次中，沒有出現在結果裡的問題都未被處理
+        result["message"] = f"❌ 批次分析未完成：{batch.status}"
+    return result
+
 @mcp.tool()
 async def etnews_finance_summary(question: str, pages: int = 1, limit: int = 5) -> str:
     """
@@ -130,11 +256,7 @@ async def etnews_finance_summary(question: str, pages: int = 1, limit: int = 5)
     if not articles:
         return "⚠️ 找不到符合條件的新聞。請換個問題試試。"
 
-    docs = [
-        f"【第 {i+1} 篇】\n標題：{a['title']}\n連結：{a['link']}\n內文：\n{a['content'][:3000]}\n"
-        for i, a in enumerate(articles[:limit])
-    ]
-    corpus = "\n".join(docs)
+    corpus = build_corpus(fit_token_budget(articles[:limit]), limit)
 
     prompt = (
         f"你是一位專業的財經分析助手。以下提供 {len(articles[:limit])} 篇 ETtoday 新聞，請先整合重點，再根據使用者提問給出專業、精簡的回覆。\n\n"
@@ -143,12 +265,8 @@ async def etnews_finance_summary(question: str, pages: int = 1, limit: int = 5)
     )
 
     try:
-        chat = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-        )
-        return chat.choices[0].message.content.strip()
+        parts = [part async for part in stream_chat(client, [{"role": "user", "content": prompt}], 0.7)]
+        return "".join(parts).strip()
     except Exception as e:
         return f"❌ GPT 分析失敗：{e}"
 
@@ -161,4 +279,5 @@ sys.excepthook = handle_exception
 
 if __name__ == "__main__":
     print("✅ Smart Finance MCP 工具正在啟動...", file=sys.stderr)
-    mcp.run()
\ No newline at end of file
+    # 以 anyio 的 use_uvloop 選項改用 uvloop 事件迴圈（uvloop.install() 自 Python 3.12 起已棄用）
+    anyio.run(mcp.run_async, backend_options={"use_uvloop": uvloop is not None})
\ No newline at end of file
@@ -1,16 +1,27 @@
 # server.py
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from fastmcp import FastMCP
 from openai import AsyncOpenAI
 import tools.mops_report
 import tools.news_summary
+from corpus import build_corpus
+from llm import ParseCache, prompt_json, stream_chat
 import os
 from dotenv import load_dotenv
-import json
+import orjson
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 load_dotenv()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 在 uvicorn 的事件迴圈內關閉爬蟲共用的 HTTP client
+    await tools.news_summary.close_client()
+
+app = FastAPI(lifespan=lifespan)
 mcp = FastMCP("smart_finance_server")   # <-- 必須有 FastMCP instance
 client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
@@ -18,9 +29,17 @@ client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 def root():
     return {"message": "Smart Finance Server + MCP is running"}
 
-@app.get("/analyze")
-async def analyze(question: str, pages: int = 1, limit: int = 5):
-    # Step 1: 語意分析
+# 語意分析結果快取；year/season 缺漏時由模型填入「最近一年/一季」，只保留 1 天以免跨季後仍沿用舊值
+_PARSE_CACHE = ParseCache(os.path.join(".cache", "analyze_parse_cache.json"), ttl=86400)
+
+async def _parse_question(question: str) -> dict:
+    """
+    將使用者問題解析為公司、股票代號、資料來源、主題與年度季度
+    """
+    cached = _PARSE_CACHE.get(question)
+    if cached is not None:
+        return cached
+
     prompt = f"""
 你是一個財經語意分析助手，請將下列問題解析為結構化的 JSON 格式。若有缺漏資訊，請合理推測或補齊。
 
@@ -41,9 +60,16 @@ stock_id, company, resourse 為必填。
     chat = await client.chat.completions.create(
         model="gpt-4o",
         messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
+        temperature=0,
     )
-    parsed = json.loads(chat.choices[0].message.content.strip())
+    parsed = orjson.loads(chat.choices[0].message.content.strip())
+    _PARSE_CACHE.set(question, parsed)
+    return parsed
+
+@app.get("/analyze")
+async def analyze(question: str, pages: int = 1, limit: int = 5, stream: bool = False):
+    # Step 1: 語意分析
+    parsed = await _parse_question(question)
     company = parsed.get("company", "")
     stock_id = parsed.get("stock_id", "")
     resourse = parsed.get("resourse", "both").lower()
@@ -68,17 +94,14 @@ stock_id, company, resourse 為必填。
         })
 
     # Step 3: 統整
-    news_text = "\n".join([
-        f"【第 {i+1} 篇】\n標題：{a['title']}\n連結：{a['link']}\n內文：\n{a['content'][:3000]}\n"
-        for i, a in enumerate(news_data[:limit])
-    ]) if news_data else "無"
+    news_text = build_corpus(tools.news_summary.fit_token_budget(news_data[:limit]), limit) if news_data else "無"
 
     combined_text = f"""【公司】{company} ({stock_id})
 【主題】{topic}
 【來源】{resourse}
 
 【MOPS財報資料】：
-{json.dumps(mops_data, ensure_ascii=False, indent=2) if mops_data else "無"}
+{prompt_json(mops_data) if mops_data else "無"}
 
 【新聞全文】：
 {news_text}
@@ -86,23 +109,26 @@ stock_id, company, resourse 為必填。
 請根據以上資料，提供針對使用者問題「{question}」的完整且具體回答。
 務必條列亮點、風險、投資建議，語氣像專業 podcast 主持人，簡單易懂但專業。"""
 
-    final_response = await client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "你是頂尖的財經分析師，擅長將複雜財經資料整理成通俗易懂的投資建議。"},
-            {"role": "user", "content": combined_text}
-        ],
-        temperature=0.5
-    )
+    messages = [
+        {"role": "system", "content": "你是頂尖的財經分析師，擅長將複雜財經資料整理成通俗易懂的投資建議。"},
+        {"role": "user", "content": combined_text}
+    ]
+
+    # stream=true 時直接把 GPT 回覆逐段送給呼叫端
+    if stream:
+        return StreamingResponse(stream_chat(client, messages, 0.5), media_type="text/plain; charset=utf-8")
+
+    final_summary = "".join([part async for part in stream_chat(client, messages, 0.5)])
 
     return {
         "question": question,
         "semantic_parse": parsed,
         "mops_data": mops_data,
         "news_data": news_data,
-        "final_summary": final_response.choices[0].message.content.strip()
+        "final_summary": final_summary.strip()
     }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=6277)  # MCP port + OpenAI可連接 port
+    # loop="auto" 在有安裝 uvloop 時會自動採用，Windows 上則退回 asyncio
+    uvicorn.run(app, host="0.0.0.0", port=6277, loop="auto")  # MCP port + OpenAI可連接 port
@@ -1,78 +1,128 @@
 # tools/mops_report.py
 from fastmcp import FastMCP
+import asyncio
 import os
-import json
+import sys
+import orjson
 import traceback
+import httpx
 import pandas as pd
-import time
-from io import StringIO
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
+from io import BytesIO
 
 mcp = FastMCP("smart_finance_server")
+_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+# 同時向 MOPS 發出的請求上限
+_MAX_CONCURRENCY = 8
+# 財報快取目錄：每張表格一個 parquet 檔，另以 {key}.meta.json 記錄表格索引
+_CACHE_DIR = os.path.join(".cache", "mops")
+
+def _table_entry(idx: int, df: pd.DataFrame) -> dict:
+    """
+    將單張表格轉成回傳給呼叫端的格式
+    """
+    return {
+        "table_index": idx,
+        "preview": df.head(3).to_string(index=False),
+        "data": df.to_dict(orient="records")
+    }
+
+def _load_cache(key: str) -> list | None:
+    """
+    讀取 parquet 快取，meta 檔不存在時回傳 None
+    """
+    meta_path = os.path.join(_CACHE_DIR, f"{key}.meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "rb") as f:
+        indices = orjson.loads(f.read())["table_indices"]
+    return [
+        _table_entry(idx, pd.read_parquet(os.path.join(_CACHE_DIR, f"{key}_{idx}.parquet")))
+        for idx in indices
+    ]
+
+def _save_cache(key: str, frames: list[tuple[int, pd.DataFrame]]) -> None:
+    """
+    每張表格各存一個 parquet 檔，最後才寫入 meta 檔，確保快取完整；中途失敗時刪除已寫出的檔案
+    """
+    written = []
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        for idx, df in frames:
+            path = os.path.join(_CACHE_DIR, f"{key}_{idx}.parquet")
+            written.append(path)
+            df.to_parquet(path, compression="zstd")
+        with open(os.path.join(_CACHE_DIR, f"{key}.meta.json"), "wb") as f:
+            f.write(orjson.dumps({"table_indices": [idx for idx, _ in frames]}))
+    except Exception as e:
+        print(f"寫入 {key} 的財報快取時發生錯誤: {e}", file=sys.stderr)
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+async def _fetch_one(sess: httpx.AsyncClient, sem: asyncio.Semaphore, stock_id: str, year: int, season: int) -> tuple[str, list | None]:
+    """
+    擷取單一公司、年度、季度的財報表格，已有快取檔時直接讀取
+    """
+    key = f"{stock_id}_{year}Q{season}"
+    try:
+        cached = _load_cache(key)
+    except Exception as e:
+        print(f"讀取 {key} 的財報快取時發生錯誤: {e}", file=sys.stderr)
+        cached = None
+    if cached is not None:
+        return key, cached
+
+    url = f"https://mopsov.twse.com.tw/server-java/t164sb01?step=3&CO_ID={stock_id}&SYEAR={year}&SSEASON={season}&REPORT_ID=C"
+    try:
+        # t164sb01 回傳的是靜態 HTML，不需要瀏覽器執行 JS
+        async with sem:
+            res = await sess.get(url, timeout=15.0)
+        res.raise_for_status()
+        # read_html 一次解析整頁，每個 <table> 對應一個 DataFrame；
+        # 直接交給 lxml 原始位元組，回應標頭沒有 charset 時由 libxml2 依 <meta> 判斷編碼
+        try:
+            dfs = pd.read_html(BytesIO(res.content), flavor="lxml", encoding=res.charset_encoding)
+        except ValueError:
+            # 頁面中沒有任何表格（如「查詢過於頻繁」或錯誤頁），不寫入快取，下次重新抓取
+            return key, None
+
+        frames = []
+        for idx, df in enumerate(dfs[:5]):
+            try:
+                if isinstance(df.columns, pd.MultiIndex):
+                    df.columns = ['_'.join([str(i) for i in col if pd.notna(i)]) for col in df.columns]
+                else:
+                    df.columns = [str(col) for col in df.columns]  # parquet 欄位名稱必須是字串
+                df.dropna(how='all', inplace=True)
+                frames.append((idx, df))
+            except Exception as e:
+                print(f"處理表格 {idx} 時發生錯誤: {e}", file=sys.stderr)
+                continue
+        if not frames:
+            return key, None
+        _save_cache(key, frames)
+        return key, [_table_entry(idx, df) for idx, df in frames]
+    except Exception as e:
+        print(f"擷取 {key} 的財報資料時發生錯誤: {e}", file=sys.stderr)
+        return key, None
 
 @mcp.tool()
 async def fetch_mops_report(stock_ids: list[str], years: list[int], seasons: list[int]) -> dict:
     """
-    使用 Selenium 從 MOPS 擷取指定公司指定年份與季度的財報表格
+    使用 httpx 從 MOPS 擷取指定公司指定年份與季度的財報表格
     """
     stock_ids = [str(sid) for sid in stock_ids]
     years = [int(y) for y in years]
     seasons = [int(s) for s in seasons]
-    all_results = {}
-
-    for stock_id in stock_ids:
-        for year in years:
-            for season in seasons:
-                key = f"{stock_id}_{year}Q{season}"
-                filename = f"{key}.json"
-                if os.path.exists(filename):
-                    with open(filename, "r", encoding="utf-8") as f:
-                        all_results[key] = json.load(f)
-                    continue
-
-                url = f"https://mopsov.twse.com.tw/server-java/t164sb01?step=3&CO_ID={stock_id}&SYEAR={year}&SSEASON={season}&REPORT_ID=C"
-                options = Options()
-                options.add_argument("--headless")
-                options.add_argument("--disable-gpu")
-                options.add_argument("window-size=1920,1080")
-                options.add_argument("user-agent=Mozilla/5.0")
-                driver = webdriver.Chrome(options=options)
-                driver.get(url)
-
-                try:
-                    WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.TAG_NAME, "table")))
-                    time.sleep(2)  # 添加延遲確保內容完全載入
-                    soup = BeautifulSoup(driver.page_source, "html.parser")
-                    tables = soup.find_all("table")
 
-                    all_tables = []
-                    for idx, table in enumerate(tables[:5]):
-                        try:
-                            html_str = str(table)
-                            df = pd.read_html(StringIO(html_str))[0]
-                            if isinstance(df.columns, pd.MultiIndex):
-                                df.columns = ['_'.join([str(i) for i in col if pd.notna(i)]) for col in df.columns]
-                            df.dropna(how='all', inplace=True)
-                            table_dict = df.to_dict(orient="records")
-                            all_tables.append({
-                                "table_index": idx,
-                                "preview": df.head(3).to_string(index=False),
-                                "data": table_dict
-                            })
-                        except Exception as e:
-                            print(f"處理表格 {idx} 時發生錯誤: {e}")
-                            continue
-                    all_results[key] = all_tables
-                    with open(filename, "w", encoding="utf-8") as f:
-                        json.dump(all_tables, f, ensure_ascii=False, indent=2)
-                except Exception as e:
-                    print(f"擷取 {key} 的財報資料時發生錯誤: {e}")
-                    all_results[key] = None
-                finally:
-                    driver.quit()
-    return all_results
\ No newline at end of file
+    sem = asyncio.Semaphore(_MAX_CONCURRENCY)
+    async with httpx.AsyncClient(headers={"User-Agent": _USER_AGENT}, follow_redirects=True) as sess:
+        results = await asyncio.gather(*(
+            _fetch_one(sess, sem, stock_id, year, season)
+            for stock_id in stock_ids
+            for year in years
+            for season in seasons
+        ))
+    return dict(results)
\ No newline at end of file
@@ -1,59 +1,322 @@
 # tools/news_summary.py
 from fastmcp import FastMCP
-import os, random, re, httpx, traceback
-from typing import List, Dict
-from bs4 import BeautifulSoup
+import os, sys, random, re, httpx, tiktoken, traceback, asyncio, hashlib, pathlib, time, zlib, functools
+from typing import Any, List, Dict
+from io import BytesIO
+from urllib.parse import urlsplit
+from lxml import etree
 
 mcp = FastMCP("smart_finance_server")
 _USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.1 Safari/605.1.15"
 ]
-HEADERS = {"User-Agent": random.choice(_USER_AGENTS)}
+# 同時進行中的請求上限，避免觸發 ETtoday 的流量限制
+_MAX_CONCURRENCY = 10
+# 跨呼叫共用的 HTTP client 與擁有其連線池的事件迴圈，由 _get_client() 延遲建立
+_CLIENT: httpx.AsyncClient | None = None
+_CLIENT_LOOP: asyncio.AbstractEventLoop | None = None
+# 文章內文快取位置與有效期限（秒）
+_CACHE_DIR = pathlib.Path(".cache/ettoday")
+_CACHE_TTL = 86400
+# 快取檔數上限，每次爬取後清除過期檔案，仍超過上限時由最舊的檔案開始刪除
+_CACHE_MAX_FILES = 2000
+# 每篇文章內文保留的字數上限
+_MAX_CONTENT_CHARS = 3000
+# 放進 prompt 的新聞內文合計 token 上限；只涵蓋新聞段落，問題、指示與 server.py 附上的財報資料另計
+_CONTENT_TOKEN_BUDGET = 7000
+_ENC = tiktoken.encoding_for_model("gpt-4o")
+# 近似重複偵測：MinHash 雜湊參數 h(x) = (a * x + b) mod p，簽章相同比例達門檻即視為重複
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PARAMS = [
+    (random.Random(seed).randrange(1, _MINHASH_PRIME), random.Random(-seed - 1).randrange(_MINHASH_PRIME))
+    for seed in range(32)
+]
+_NEAR_DUP_THRESHOLD = 0.8
+# 內文短於此長度不做近似比對，5-gram 太少時相似度估計不可靠
+_MIN_DEDUP_CHARS = 100
+
+def _has_class(name: str) -> str:
+    """
+    產生比對 class 屬性中完整類別名稱的 XPath 條件（等同 CSS 的 .name）
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# 搜尋結果區塊內使用的 XPath 與日期格式，於載入時編譯一次
+_TITLE_XPATH = etree.XPath(".//h2/a")
+_DATE_XPATH = etree.XPath(f".//p[{_has_class('detail')}]//span[{_has_class('date')}]")
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+# 內文中的 <script>/<style> 是廣告與版面程式碼，不計入文字
+_TEXT_XPATH = etree.XPath(".//text()[not(ancestor::script) and not(ancestor::style)]")
+
+def _text_lines(el) -> str:
+    """
+    取出節點內所有文字（略過 script 與 style），每段去除空白後以換行串接
+    """
+    return "\n".join(t.strip() for t in _TEXT_XPATH(el) if t.strip())
+
+def _iter_boxes(content: bytes, encoding: str | None = None):
+    """
+    以 iterparse 逐一產出搜尋頁中的 .box_2 區塊，處理完即清空以釋放記憶體
+    """
+    for _, el in etree.iterparse(BytesIO(content), events=("end",), tag="div", html=True, encoding=encoding):
+        if "box_2" in (el.get("class") or "").split():
+            yield el
+            el.clear()
+
+def _find_main(content: bytes, encoding: str | None = None):
+    """
+    以 iterparse 尋找文章主體，遇到 #main-content 即停止解析，否則退回 .story
+    """
+    story = None
+    for _, el in etree.iterparse(BytesIO(content), events=("end",), tag="div", html=True, encoding=encoding):
+        if el.get("id") == "main-content":
+            return el
+        if story is None and "story" in (el.get("class") or "").split():
+            story = el
+    return story
+
+async def _rotate_user_agent(request: httpx.Request) -> None:
+    """
+    每個請求送出前隨機挑選 User-Agent，降低被限流的機率
+    """
+    request.headers["User-Agent"] = random.choice(_USER_AGENTS)
+
+def _get_client() -> httpx.AsyncClient:
+    """
+    取得共用的 AsyncClient，第一次呼叫時才建立，之後在同一個事件迴圈內的呼叫沿用同一個連線池
+    """
+    global _CLIENT, _CLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    # 連線池綁定在建立它的事件迴圈上，迴圈換了（如每次 asyncio.run）就必須重建
+    if _CLIENT is None or _CLIENT.is_closed or _CLIENT_LOOP is not loop:
+        _CLIENT_LOOP = loop
+        _CLIENT = httpx.AsyncClient(
+            # 搜尋頁與文章頁皆以 asyncio.gather 併發抓取，HTTP/2 可在同一條連線上多工傳輸，
+            # 省下額外的 TCP/TLS 連線；若改回逐篇循序抓取，應改用 HTTP/1.1 並加大連線池
+            http2=True,
+            event_hooks={"request": [_rotate_user_agent]},
+            follow_redirects=True,
+            timeout=httpx.Timeout(20.0, connect=5.0),
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=60),
+        )
+    return _CLIENT
+
+async def close_client() -> None:
+    """
+    關閉共用的 AsyncClient，須由伺服器的 shutdown 流程在擁有連線池的事件迴圈內呼叫
+    """
+    global _CLIENT
+    if _CLIENT is not None and not _CLIENT.is_closed and _CLIENT_LOOP is asyncio.get_running_loop():
+        await _CLIENT.aclose()
+    _CLIENT = None
+
+async def _fetch(sess: httpx.AsyncClient, sem: asyncio.Semaphore, url: str, timeout: float) -> httpx.Response:
+    """
+    在併發上限內送出 GET 請求，失敗時直接拋出例外
+    """
+    async with sem:
+        res = await sess.get(url, timeout=timeout)
+        res.raise_for_status()
+        return res
+
+def _cache_path(link: str) -> pathlib.Path:
+    """
+    以網址的 SHA-1 作為快取檔名
+    """
+    return _CACHE_DIR / f"{hashlib.sha1(link.encode()).hexdigest()}.txt"
+
+def _read_cache(link: str) -> str | None:
+    """
+    讀取未過期的文章內文快取，不存在或已過期時回傳 None
+    """
+    path = _cache_path(link)
+    try:
+        if time.time() - path.stat().st_mtime < _CACHE_TTL:
+            return path.read_text(encoding="utf-8")
+    except OSError:
+        pass
+    return None
+
+def _write_cache(link: str, content: str) -> None:
+    """
+    將解析後的文章內文寫入快取（只存內文，不存整頁 HTML）
+    """
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _cache_path(link).write_text(content, encoding="utf-8")
+    except OSError:
+        pass
+
+def _prune_cache() -> None:
+    """
+    刪除過期的文章內文快取，剩餘檔案超過上限時再依寫入時間由舊到新刪除
+    """
+    entries = []
+    for path in _CACHE_DIR.glob("*.txt"):
+        try:
+            entries.append((path.stat().st_mtime, path))
+        except OSError:
+            pass
+    entries.sort(key=lambda e: e[0])
+
+    now = time.time()
+    excess = len(entries) - _CACHE_MAX_FILES
+    for i, (mtime, path) in enumerate(entries):
+        # 由舊到新排列，遇到第一個未過期且不在超額範圍內的檔案即可停止
+        if now - mtime < _CACHE_TTL and i >= excess:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+async def _fetch_article(sess: httpx.AsyncClient, sem: asyncio.Semaphore, link: str) -> tuple[str, bool]:
+    """
+    取得單篇文章內文，快取未過期時直接使用快取；回傳內文與是否成功取得
+    """
+    cached = _read_cache(link)
+    if cached is not None:
+        return cached[:_MAX_CONTENT_CHARS], True
+
+    try:
+        res = await _fetch(sess, sem, link, 20.0)
+        # 依回應標頭的 charset 解碼，頁面沒有 <meta charset> 時才不會被當成 Latin-1
+        main = _find_main(res.content, res.charset_encoding)
+    except Exception as e:
+        return f"(抓取失敗: {e})", False
+    if main is None:
+        return "(無法取得內文)", False
+
+    # 只保留前段內文，完整文字不再往下傳遞
+    content = _text_lines(main)[:_MAX_CONTENT_CHARS].strip()
+    _write_cache(link, content)
+    return content, True
+
+@functools.lru_cache(maxsize=1024)
+def _count_tokens(text: str) -> int:
+    """
+    計算文字以 gpt-4o 編碼後的 token 數，同一段內文在同一個行程中只編碼一次
+    """
+    return len(_ENC.encode(text))
+
+def _truncate_tokens(text: str, cap: int) -> str:
+    """
+    截取前 cap 個 token；中文字可能跨 token，截斷處不完整的位元組直接捨棄，避免留下 U+FFFD
+    """
+    return _ENC.decode_bytes(_ENC.encode(text)[:cap]).decode("utf-8", errors="ignore")
+
+def fit_token_budget(articles: List[Dict[str, Any]], budget: int = _CONTENT_TOKEN_BUDGET) -> List[Dict[str, Any]]:
+    """
+    依 token 預算分配各篇文章的內文長度，短文章用不完的額度會分給較長的文章
+    """
+    # 使用爬取時記錄的 token 數，只有需要截斷的文章才重新編碼
+    counts = [a["tokens"] if "tokens" in a else _count_tokens(a["content"]) for a in articles]
+    caps = [0] * len(articles)
+    remaining = budget
+    # 由短到長分配，每篇最多取得剩餘額度的平均值
+    order = sorted(range(len(articles)), key=lambda i: counts[i])
+    for n, i in enumerate(order):
+        caps[i] = min(counts[i], remaining // (len(articles) - n))
+        remaining -= caps[i]
+
+    return [
+        {**a, "content": _truncate_tokens(a["content"], cap), "tokens": cap} if count > cap else a
+        for a, count, cap in zip(articles, counts, caps)
+    ]
+
+def _normalize_link(link: str) -> str:
+    """
+    去除網址的查詢參數與錨點（如 ?from=...），讓同一篇文章只對應一個網址
+    """
+    return urlsplit(link)._replace(query="", fragment="").geturl()
+
+def _minhash(text: str) -> List[int]:
+    """
+    以內文前 500 字的 5-gram 計算 MinHash 簽章
+    """
+    head = text[:500]
+    shingles = [zlib.crc32(head[i:i + 5].encode()) for i in range(len(head) - 4)]
+    return [min((a * x + b) % _MINHASH_PRIME for x in shingles) for a, b in _MINHASH_PARAMS]
+
+def _is_near_duplicate(sig: List[int], kept: List[List[int]]) -> bool:
+    """
+    與任一已保留文章的估計相似度達門檻即視為重複
+    """
+    return any(
+        sum(x == y for x, y in zip(sig, other)) >= _NEAR_DUP_THRESHOLD * len(sig)
+        for other in kept
+    )
 
 @mcp.tool()
-async def crawl_etnews_articles(keyword: str, pages: int = 1) -> List[Dict[str, str]]:
+async def crawl_etnews_articles(keyword: str, pages: int = 1) -> List[Dict[str, Any]]:
     """
-    根據關鍵字爬取 ETtoday 搜尋結果，並回傳每篇的標題、連結、內文與日期
+    根據關鍵字爬取 ETtoday 搜尋結果，並回傳每篇的標題、連結、內文、日期與內文 token 數
     """
     articles = []
-    async with httpx.AsyncClient(http2=True, headers=HEADERS, follow_redirects=True) as sess:
-        for page in range(1, pages + 1):
-            url = f"https://www.ettoday.net/news_search/doSearch.php?keywords={keyword}&page={page}"
-            try:
-                res = await sess.get(url, timeout=15.0)
-                res.raise_for_status()
-            except Exception as e:
-                print(f"搜尋頁面獲取失敗: {e}")
-                continue
+    sem = asyncio.Semaphore(_MAX_CONCURRENCY)
+    sess = _get_client()
+    # 所有搜尋頁同時抓取
+    urls = [
+        f"https://www.ettoday.net/news_search/doSearch.php?keywords={keyword}&page={page}"
+        for page in range(1, pages + 1)
+    ]
+    pages_res = await asyncio.gather(
+        *(_fetch(sess, sem, url, 15.0) for url in urls),
+        return_exceptions=True,
+    )
 
-            soup = BeautifulSoup(res.text, "lxml")
+    metas = []
+    seen_links: set[str] = set()
+    for res in pages_res:
+        if isinstance(res, Exception):
+            print(f"搜尋頁面獲取失敗: {res}", file=sys.stderr)
+            continue
 
-            for box in soup.select(".box_2"):
-                title_tag = box.select_one("h2 a")
-                date_tag = box.select_one("p.detail span.date")
-                if not title_tag or not date_tag:
+        # 空白回應或 libxml2 不認得的 charset 會讓解析拋出例外，只略過該搜尋頁
+        try:
+            for box in _iter_boxes(res.content, res.charset_encoding):
+                title_tags = _TITLE_XPATH(box)
+                date_tags = _DATE_XPATH(box)
+                if not title_tags or not date_tags:
                     continue
 
-                title = title_tag.text.strip()
-                link = title_tag["href"]
-                date_match = re.search(r"\d{4}-\d{2}-\d{2}", date_tag.text)
+                title = "".join(title_tags[0].itertext()).strip()
+                href = title_tags[0].get("href")
+                if not href:
+                    continue
+                # 同一篇文章可能出現在多個搜尋頁，只抓一次
+                link = _normalize_link(href)
+                if link in seen_links:
+                    continue
+                seen_links.add(link)
+                date_match = _DATE_RE.search("".join(date_tags[0].itertext()))
                 news_date = date_match.group(0) if date_match else ""
+                metas.append((title, link, news_date))
+        except (etree.LxmlError, LookupError) as e:
+            print(f"搜尋頁面解析失敗: {e}", file=sys.stderr)
+
+    # 所有文章頁同時抓取，快取命中的文章不發送請求
+    contents = await asyncio.gather(
+        *(_fetch_article(sess, sem, link) for _, link, _ in metas)
+    )
+    _prune_cache()
+
+    kept_sigs = []
+    for (title, link, news_date), (content, fetched) in zip(metas, contents):
+        # 不同網址但內容幾乎相同的轉載文章只保留第一篇；抓取失敗的提示訊息彼此相似，不參與比對
+        if fetched and len(content) >= _MIN_DEDUP_CHARS:
+            sig = _minhash(content)
+            if _is_near_duplicate(sig, kept_sigs):
+                continue
+            kept_sigs.append(sig)
 
-                try:
-                    art_res = await sess.get(link, timeout=20.0)
-                    art_res.raise_for_status()
-                    art_soup = BeautifulSoup(art_res.text, "lxml")
-                    main = art_soup.select_one("#main-content") or art_soup.select_one(".story")
-                    content = main.get_text("\n", strip=True) if main else "(無法取得內文)"
-                except Exception as e:
-                    content = f"(抓取失敗: {e})"
-
-                articles.append({
-                    "title": title,
-                    "link": link,
-                    "date": news_date,
-                    "content": content,
-                    "keyword": keyword
-                })
+        articles.append({
+            "title": title,
+            "link": link,
+            "date": news_date,
+            "content": content,
+            "tokens": _count_tokens(content),
+            "keyword": keyword
+        })
     return articles
\ No newline at end of file